@@ -13,9 +13,63 @@ IF YOU EDIT MODIFY THIS PLEASE
 
 
 
+import json
+import os
+import time
+import warnings
+
+import numpy as np
+
 from qcodes import VisaInstrument
 from qcodes.utils.validators import Numbers
 
+class HM8133FastPath:
+    """
+    Low overhead access to the hot HM8133 setters for tight loops.
+    Commands are pre-formatted and sent straight to the VISA handle,
+    bypassing the qcodes parameter machinery. The cached values of the
+    matching parameters are updated with the values actually sent.
+    """
+
+    def __init__(self, instrument):
+        """
+        Args:
+            instrument (HM8133): The parent instrument
+        """
+        self._visa_handle = instrument.visa_handle
+        self._frequency = instrument.frequency
+        self._lvl_volts = instrument.lvl_volts
+        # same commands and ranges as the parameters
+        self._frq_fmt = "{:.9E}".format
+        self._amp_fmt = "{:.10E}".format
+        self._frq_range = (self._frequency.vals._min_value,
+                           self._frequency.vals._max_value)
+        self._amp_range = (self._lvl_volts.vals._min_value,
+                           self._lvl_volts.vals._max_value)
+
+    def set_frequency(self, value):
+        """
+        Set the frequency to value (Hz)
+        """
+        if not self._frq_range[0] <= value <= self._frq_range[1]:
+            raise ValueError("{} is out of the frequency range {}"
+                             .format(value, self._frq_range))
+        sent = self._frq_fmt(value)
+        self._visa_handle.write("FRQ;" + sent)
+        self._frequency._save_val(float(sent))
+
+    def set_lvl_volts(self, value):
+        """
+        Set the level to value (V)
+        """
+        if not self._amp_range[0] <= value <= self._amp_range[1]:
+            raise ValueError("{} is out of the level range {}"
+                             .format(value, self._amp_range))
+        sent = self._amp_fmt(value)
+        self._visa_handle.write("AMP;" + sent)
+        self._lvl_volts._save_val(float(sent))
+
+
 class HM8133(VisaInstrument):
     """
     This is the qcodes driver for the HAMEG HM 8133
@@ -63,7 +117,7 @@ class HM8133(VisaInstrument):
         self.add_parameter("frequency",
                            label="Frequency",
                            get_cmd="FRQ?",
-                           set_cmd="FRQ;{:.1E}",
+                           set_cmd="FRQ;{:.9E}",
                            unit="Hz",
                            vals=Numbers(min_value=1, max_value=1e9))
 
@@ -144,6 +198,9 @@ class HM8133(VisaInstrument):
                                      "state: freq = 1 GHz, amp = +7dBm,"
                                      "modulation = off, output = off"
                                      "ref freq = internal."))      
+
+        # Fast path for hot loops
+        self.fast = HM8133FastPath(self)
         
 #NOT WORKING        
     def _get_output(self,s):
@@ -153,4 +210,178 @@ class HM8133(VisaInstrument):
         return s[8:11]
     
     def _get_ref(self,s):
-        return self._ANSWER_PARSER[s[4:7]]
\ No newline at end of file
+        return self._ANSWER_PARSER[s[4:7]]
+
+
+class HM8133Leveling:
+    """
+    Output leveling of an HM8133 from a cached calibration table.
+
+    The table holds a correction in dB over frequency, measured once with
+    a detector parameter (e.g. SR844.R) and stored in a json file, keyed
+    by the who and version of the source and a setup string. Sweeps apply
+    the interpolated correction up front and only re-calibrate points
+    whose error is above the tolerance.
+
+    The level is set through lvl_volts, since setting lvl_dbm is not
+    working.
+    """
+
+    def __init__(self, source, detector, path, setup=""):
+        """
+        Args:
+            source (HM8133): The leveled synthesizer
+            detector (Parameter): Reading proportional to the output
+                amplitude, e.g. SR844.R
+            path (str): The json file of the calibration tables
+            setup (str): Describes the setup (cabling, detector, ...)
+        """
+        self.source = source
+        self.detector = detector
+        self.path = path
+        self.key = "{}|{}|{}".format(source.who().strip(),
+                                     source.version().strip(), setup)
+
+        self.frequencies = None
+        self.correction_db = None
+        self.reference = None
+        self.level = None
+        self.load()
+
+    def load(self):
+        """
+        Load the table of this key from the json file, if there is one.
+        """
+        table = self._read_file().get(self.key)
+        if table is not None:
+            self.frequencies = np.array(table["frequencies"])
+            self.correction_db = np.array(table["correction_db"])
+            self.reference = table["reference"]
+            self.level = table["level"]
+
+    def save(self):
+        """
+        Store the table of this key in the json file.
+        """
+        tables = self._read_file()
+        tables[self.key] = {"frequencies": list(self.frequencies),
+                            "correction_db": list(self.correction_db),
+                            "reference": self.reference,
+                            "level": self.level}
+        with open(self.path, "w") as f:
+            json.dump(tables, f, indent=1)
+
+    def _read_file(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def calibrate(self, frequencies, level, settle=0, reference=None):
+        """
+        Measure the correction table and save it.
+
+        Args:
+            frequencies (sequence): Calibration frequencies in Hz
+            level (float): Output level in V during calibration
+            settle (float): Settling time in s before every reading
+            reference (float): Detector reading the output is leveled to
+                at this level. Defaults to the reading at the first
+                frequency.
+        """
+        frequencies = np.sort(np.asarray(frequencies, dtype=float))
+        self.source.lvl_volts(level)
+        readings = np.empty(len(frequencies))
+        for i, f in enumerate(frequencies):
+            self.source.fast.set_frequency(f)
+            if settle:
+                time.sleep(settle)
+            readings[i] = self._read()
+
+        if reference is None:
+            reference = readings[0]
+        if not reference > 0:
+            raise ValueError("Leveling reference must be positive, "
+                             "got {}".format(reference))
+        self.frequencies = frequencies
+        self.correction_db = 20*np.log10(reference/readings)
+        self.reference = float(reference)
+        self.level = level
+        self.save()
+
+    def correction(self, frequency):
+        """
+        Interpolated correction in dB at frequency
+        """
+        if self.frequencies is None:
+            raise RuntimeError("No leveling calibration for {}. Please run "
+                               "calibrate".format(self.key))
+        return np.interp(frequency, self.frequencies, self.correction_db)
+
+    def sweep(self, frequencies, level, settle=0, tolerance_db=0.1):
+        """
+        Leveled frequency sweep. Returns numpy array of detector readings
+
+        Args:
+            frequencies (sequence): Sweep frequencies in Hz
+            level (float): Leveled output level in V
+            settle (float): Settling time in s before every reading
+            tolerance_db (float): Points with a larger error are
+                re-calibrated and measured again.
+        """
+        if self.frequencies is None:
+            raise RuntimeError("No leveling calibration for {}. Please run "
+                               "calibrate".format(self.key))
+        lvl_min, lvl_max = self.source.fast._amp_range
+        expected = self.reference*level/self.level
+        readings = []
+        changed = False
+        for f in frequencies:
+            corr = self.correction(f)
+            reading = self._set_and_read(f, level*10**(corr/20), settle,
+                                         lvl_min, lvl_max)
+            err = 20*np.log10(expected/reading)
+            if abs(err) > tolerance_db:
+                corr += err
+                volts = level*10**(corr/20)
+                if not lvl_min <= volts <= lvl_max:
+                    # out of range, re-calibrating would not help
+                    warnings.warn("Can not level {} Hz to {} V, the "
+                                  "corrected level {} V is out of range"
+                                  .format(f, level, volts))
+                else:
+                    self._update(f, corr)
+                    changed = True
+                    reading = self._set_and_read(f, volts, settle,
+                                                 lvl_min, lvl_max)
+            readings.append(reading)
+
+        if changed:
+            self.save()
+        return np.array(readings)
+
+    def _set_and_read(self, f, volts, settle, lvl_min, lvl_max):
+        self.source.fast.set_frequency(f)
+        self.source.fast.set_lvl_volts(min(max(volts, lvl_min), lvl_max))
+        if settle:
+            time.sleep(settle)
+        return self._read()
+
+    def _read(self):
+        reading = self.detector()
+        # also catches nan
+        if not reading > 0:
+            raise ValueError("Leveling needs a positive detector reading, "
+                             "got {} from {}".format(reading,
+                                                     self.detector.name))
+        return reading
+
+    def _update(self, f, corr):
+        i = np.searchsorted(self.frequencies, f)
+        # same point only within the 1 Hz resolution of the source
+        if i < len(self.frequencies) and np.isclose(self.frequencies[i], f,
+                                                    rtol=0, atol=0.5):
+            self.correction_db[i] = corr
+        else:
+            self.frequencies = np.insert(self.frequencies, i, f)
+            self.correction_db = np.insert(self.correction_db, i, corr)
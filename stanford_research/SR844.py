@@ -1,5 +1,7 @@
 from functools import partial
+import time
 import numpy as np
+from pyvisa.errors import VisaIOError
 
 from qcodes import VisaInstrument
 from qcodes.instrument.parameter import ArrayParameter
@@ -9,9 +11,9 @@ class ChannelBuffer(ArrayParameter):
     """
     Parameter class for the two channel buffers
 
-    Currently always returns the entire buffer
-    TODO (WilliamHPNielsen): Make it possible to query parts of the buffer.
-    The instrument natively supports this in its TRCL call.
+    Currently always returns the entire buffer. The transfer is split
+    into TRCL calls of at most chunk_size points; a failed chunk is retried
+    from its own offset and the outcome is stored in last_transfer.
     """
 
     def __init__(self, name: str, instrument: 'SR844', channel: int) -> None:
@@ -44,6 +46,12 @@ class ChannelBuffer(ArrayParameter):
         self.channel = channel
         self._instrument = instrument
 
+        # number of points per TRCL transfer and retries per chunk
+        self.chunk_size = 1024
+        self.max_retries = 3
+        # integrity report of the last buffer transfer
+        self.last_transfer = None
+
     def prepare_buffer_readout(self):
         """
         Function to generate the setpoints for the channel buffer and
@@ -87,6 +95,7 @@ class ChannelBuffer(ArrayParameter):
         """
         Get command. Returns numpy array
         """
+        self.last_transfer = None
         if self.channel == 1:
             ready = self._instrument._buffer1_ready
         else:
@@ -100,17 +109,118 @@ class ChannelBuffer(ArrayParameter):
             raise ValueError('No points stored in SR844 data buffer.'
                              ' Can not poll anything.')
 
-        # poll raw binary data
-        self._instrument.write('TRCL ? {}, 0, {}'.format(self.channel, N))
-        rawdata = self._instrument.visa_handle.read_raw()
+        if self.shape[0] != N:
+            raise RuntimeError("SR8344 got {} points in buffer expected {}".format(N, self.shape[0]))
+
+        # poll raw binary data, chunk by chunk
+        self.last_transfer = {'npts': N,
+                              'bytes': 0,
+                              'chunks': 0,
+                              'retries': 0,
+                              'failed_at': None}
+        rawdata = bytearray()
+        for start in range(0, N, self.chunk_size):
+            npts = min(self.chunk_size, N - start)
+            self._read_chunk(rawdata, start, npts)
 
         # parse it
-        realdata = np.fromstring(rawdata, dtype='<i2')
+        realdata = np.frombuffer(bytes(rawdata), dtype='<i2')
         numbers = realdata[::2]*2.0**(realdata[1::2]-124)
-        if self.shape[0] != N:
-            raise RuntimeError("SR8344 got {} points in buffer expected {}".format(N, self.shape[0]))
         return numbers
 
+    def _read_chunk(self, rawdata, start, npts):
+        """
+        Read npts points starting at buffer index start and append the raw
+        bytes to rawdata. A failed or short read is retried from the same
+        offset, so data that already arrived is not read again. Progress,
+        retries and a failed chunk are recorded in last_transfer.
+        """
+        nbytes = 4*npts  # two int16 per point
+        visa_handle = self._instrument.visa_handle
+        report = self.last_transfer
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                report['retries'] += 1
+            try:
+                self._instrument.write('TRCL ? {}, {}, {}'.format(
+                    self.channel, start, npts))
+                chunk = visa_handle.read_bytes(nbytes)
+            except VisaIOError:
+                chunk = b''
+            if len(chunk) == nbytes:
+                rawdata.extend(chunk)
+                report['bytes'] += nbytes
+                report['chunks'] += 1
+                return
+            # discard whatever is left of the failed chunk; a clear that
+            # times out just counts as part of the failed attempt
+            try:
+                visa_handle.clear()
+            except VisaIOError:
+                pass
+
+        report['failed_at'] = start
+        raise RuntimeError('SR844 buffer transfer failed at point {} after '
+                           '{} retries'.format(start, self.max_retries))
+
+
+class SR844FastPath:
+    """
+    Low overhead access to a few hot SR844 operations for tight loops.
+    Commands are pre-formatted and sent straight to the VISA handle,
+    bypassing validation, parsing and logging of the qcodes parameters.
+    The cached values of the matching parameters are still updated.
+    """
+
+    def __init__(self, instrument: 'SR844') -> None:
+        """
+        Args:
+            instrument (SR844): The parent instrument
+        """
+        self._visa_handle = instrument.visa_handle
+        self._snap_xy = 'SNAP? {},{}'.format(instrument._SNAP_TO_N['X'],
+                                             instrument._SNAP_TO_N['Y'])
+        self._aux_min = instrument._AUX_OUT_VALS._min_value
+        self._aux_max = instrument._AUX_OUT_VALS._max_value
+
+        params = instrument.parameters
+        self._X = params['X']
+        self._Y = params['Y']
+        self._aux_in = {i: params['aux_in{}'.format(i)] for i in (1, 2)}
+        self._aux_out = {i: params['aux_out{}'.format(i)] for i in (1, 2)}
+        self._aux_in_cmd = {i: 'AUXI? {}'.format(i) for i in (1, 2)}
+        self._aux_out_cmd = {i: 'AUXV {}, {{:.3f}}'.format(i).format
+                             for i in (1, 2)}
+
+    def read_xy(self):
+        """
+        Read X and Y simultaneously. Returns numpy array [X, Y]
+        """
+        xy = np.fromstring(self._visa_handle.query(self._snap_xy), sep=',')
+        self._X._save_val(xy[0])
+        self._Y._save_val(xy[1])
+        return xy
+
+    def read_aux(self, channel):
+        """
+        Read aux input 1 or 2. Returns float
+        """
+        v = float(self._visa_handle.query(self._aux_in_cmd[channel]))
+        self._aux_in[channel]._save_val(v)
+        return v
+
+    def set_aux(self, channel, value):
+        """
+        Set aux output 1 or 2 to value (V)
+        """
+        if not self._aux_min <= value <= self._aux_max:
+            raise ValueError('{} is out of the aux output range [{}, {}]'
+                             .format(value, self._aux_min, self._aux_max))
+        # AUXV has 1 mV resolution
+        value = round(float(value), 3)
+        self._visa_handle.write(self._aux_out_cmd[channel](value))
+        self._aux_out[channel]._save_val(value)
+
 
 class SR844(VisaInstrument):
     """
@@ -141,6 +251,13 @@ class SR844(VisaInstrument):
 #     _N_TO_CURR = {v: k for k, v in _CURR_TO_N.items()}
 
     _VOLT_ENUM = Enum(*_VOLT_TO_N.keys())
+
+    # Parameter indices of the SNAP? command
+    _SNAP_TO_N = {'X': 1, 'Y': 2, 'R': 3, 'R[dBm]': 4, 'P': 5,
+                  'aux_in1': 6, 'aux_in2': 7, 'frequency': 8,
+                  'ch1_display': 9, 'ch2_display': 10}
+
+    _AUX_OUT_VALS = Numbers(min_value=-10.5, max_value=10.5)
 #     _CURR_ENUM = Enum(*_CURR_TO_N.keys())
 
 #     _INPUT_CONFIG_TO_N = {
@@ -351,7 +468,8 @@ class SR844(VisaInstrument):
                                get_cmd='AUXO? {}'.format(i),
                                get_parser=float,
                                set_cmd='AUXV {0}, {{}}'.format(i),
-                               unit='V')
+                               unit='V',
+                               vals=self._AUX_OUT_VALS)
 
         # Setup
         self.add_parameter('output_interface',
@@ -489,8 +607,155 @@ class SR844(VisaInstrument):
         self._buffer1_ready = False
         self._buffer2_ready = False
 
+        # fast path for hot loops
+        self.fast = SR844FastPath(self)
+
         self.connect_message()
 
+    def triggered_sweep(self, set_param, values, delay=0, channels=(1,)):
+        """
+        Step a source parameter through a list of values and store one
+        buffer point per value by software trigger. The buffer is read out
+        with a single transfer per channel once the sweep is done, so
+        there is no readout round trip per point.
+
+        Args:
+            set_param (Parameter): The swept parameter, e.g. the frequency
+                of an HM8133.
+            values (sequence): The values to step set_param through.
+            delay (float): Settling time in seconds after every step,
+                before the trigger is sent.
+            channels (tuple): The buffer channels to read out. Only
+                channels with a chN_databuffer parameter are allowed.
+
+        Returns:
+            list: One numpy array per channel, with the buffer setpoints
+                set to the swept values.
+        """
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            raise ValueError('Can not sweep over an empty list of values.')
+        for ch in channels:
+            if 'ch{}_databuffer'.format(ch) not in self.parameters:
+                raise ValueError('No data buffer for channel {}.'.format(ch))
+        if set_param.vals is not None:
+            for value in values:
+                set_param.vals.validate(value)
+
+        self.buffer_SR('Trigger')
+        self.buffer_trig_mode('OFF')
+        self.buffer_reset()
+        self.buffer_start()
+
+        # never leave the buffer running if a step fails
+        try:
+            for value in values:
+                set_param.set(value)
+                if delay:
+                    time.sleep(delay)
+                self.send_trigger()
+        finally:
+            self.buffer_pause()
+
+        data = []
+        for ch in channels:
+            buf = self.parameters['ch{}_databuffer'.format(ch)]
+            buf.prepare_buffer_readout()
+            if buf.shape[0] != len(values):
+                raise RuntimeError('SR844 stored {} points in buffer, sweep '
+                                   'has {}'.format(buf.shape[0], len(values)))
+            # map trigger events to the swept values
+            buf.setpoint_units = (set_param.unit,)
+            buf.setpoint_names = (set_param.name,)
+            buf.setpoint_labels = (set_param.label,)
+            buf.setpoints = (tuple(values),)
+            data.append(buf.get())
+
+        return data
+
+    def ramp_aux(self, channel, trajectory, max_rate, step_time=0.01,
+                 readout=('X', 'Y')):
+        """
+        Ramp an aux output through a trajectory of voltages without
+        exceeding a slew rate, reading the outputs at every step. Each AUXV
+        write is sent together with the SNAP? query of that step, so a
+        step costs a single round trip.
+
+        The arguments are checked and the steps computed when called;
+        the returned generator runs the ramp. Closing it (or breaking out
+        of the loop) stops the ramp and leaves the aux output at the last
+        value written.
+
+        Args:
+            channel (int): The aux output (1 or 2).
+            trajectory (sequence): Voltages to ramp through, in order,
+                starting from the present output value.
+            max_rate (float): Maximum slew rate in V/s.
+            step_time (float): Time between two steps in seconds. It is
+                stretched if max_rate allows less than 1 mV per step.
+            readout (tuple): Names of the SNAP? parameters read at every
+                step, see _SNAP_TO_N. At least two are required.
+
+        Returns:
+            generator: Yields a tuple per step, the aux voltage followed
+                by the readout values.
+        """
+        if channel not in (1, 2):
+            raise ValueError('Invalid aux output. SR844 only has aux '
+                             'outputs 1 and 2.')
+        if max_rate <= 0 or step_time <= 0:
+            raise ValueError('max_rate and step_time must be positive.')
+        if not 2 <= len(readout) <= 6:
+            raise ValueError('SNAP? reads between 2 and 6 parameters.')
+        for p in readout:
+            if p not in self._SNAP_TO_N:
+                raise ValueError('{} not in {}'.format(
+                    p, list(self._SNAP_TO_N.keys())))
+        trajectory = np.asarray(trajectory, dtype=float).ravel()
+        for v in trajectory:
+            self._AUX_OUT_VALS.validate(v)
+
+        aux_out = self.parameters['aux_out{}'.format(channel)]
+        cmd = 'AUXV {}, {{:.3f}};SNAP? {}'.format(
+            channel, ','.join(str(self._SNAP_TO_N[p]) for p in readout))
+
+        # AUXV has 1 mV resolution, so steps are whole mV. If max_rate
+        # allows less than 1 mV per step_time, step_time is stretched
+        # instead, so no leg is faster than max_rate.
+        step_mv = max(int(np.floor(max_rate*step_time*1e3 + 1e-9)), 1)
+        step_time = max(step_time, step_mv*1e-3/max_rate)
+
+        # precompute the steps in mV
+        start = int(round(aux_out.get()*1e3))
+        steps = []
+        for target in trajectory:
+            target = int(round(target*1e3))
+            diff = abs(target - start)
+            sign = 1 if target >= start else -1
+            n = max(-(-diff//step_mv), 1)
+            steps.extend((start + sign*min(k*step_mv, diff))/1e3
+                         for k in range(1, n + 1))
+            start = target
+
+        return self._ramp_aux_steps(aux_out, cmd, steps, step_time)
+
+    def _ramp_aux_steps(self, aux_out, cmd, steps, step_time):
+        """
+        Generator running the precomputed steps of ramp_aux
+        """
+        next_time = time.perf_counter()
+        for v in steps:
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # schedule from the actual step time, so a stall is not made
+            # up by running the late steps back to back
+            next_time = max(next_time, time.perf_counter()) + step_time
+            resp = self.ask(cmd.format(v))
+            # keep the parameter cache in step with the output
+            aux_out._save_val(v)
+            yield (v,) + tuple(float(x) for x in resp.split(','))
+
     def _set_buffer_SR(self, SR):
         self.write('SRAT {}'.format(SR))
         self._buffer1_ready = False